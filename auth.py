@@ -1,10 +1,73 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import orjson
 import requests
+from cachetools import LRUCache, TTLCache
+from requests.adapters import HTTPAdapter
 from google.oauth2.credentials import Credentials
 from config import GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET
 
-def always_refresh_user_tokens(refresh_token: str) -> Credentials:
-    """Always refresh Google OAuth tokens to ensure they're valid."""
-    token_url = "https://oauth2.googleapis.com/token"
+TOKEN_URL = "https://oauth2.googleapis.com/token"
+SCOPES = ["https://www.googleapis.com/auth/analytics.readonly"]
+
+# google-auth treats credentials as stale this long (3m45s, its private
+# google.auth._helpers.REFRESH_THRESHOLD) before expiry, and then refreshes
+# them inline on the next RPC, outside this module's cache and locks
+GOOGLE_AUTH_REFRESH_THRESHOLD_SECONDS = 225
+
+# Refresh this many seconds before Google's reported expiry, so cached
+# credentials are replaced before google-auth would do it on its own
+EXPIRY_MARGIN_SECONDS = GOOGLE_AUTH_REFRESH_THRESHOLD_SECONDS + 60
+
+# (connect, read) timeouts for the token endpoint
+TOKEN_REQUEST_TIMEOUT = (3, 10)
+
+# Shared keep-alive pool so refreshes don't pay a TLS handshake each time
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
+# refresh_token -> credentials; their expiry is read from the credentials
+# themselves, so a refresh google-auth performs on its own is seen here too.
+# Entries expire an hour after their last refresh, when the access token
+# they hold is spent, so rotated and idle tokens drop out.
+_token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+_token_cache_lock = threading.Lock()
+_token_locks: LRUCache = LRUCache(maxsize=10_000)
+_token_locks_guard = threading.Lock()
+# refresh_token -> refresh currently running for async callers
+_inflight_refreshes: dict[str, asyncio.Future] = {}
+
+
+class InvalidGrantError(Exception):
+    """Raised when Google rejects a refresh token with `invalid_grant`."""
+
+
+def _get_token_lock(refresh_token: str) -> threading.Lock:
+    with _token_locks_guard:
+        lock = _token_locks.get(refresh_token)
+        if lock is None:
+            lock = _token_locks[refresh_token] = threading.Lock()
+        return lock
+
+
+def _expiry_epoch(creds: Credentials) -> float:
+    # google-auth keeps expiry as naive UTC
+    return creds.expiry.replace(tzinfo=timezone.utc).timestamp() if creds.expiry else 0.0
+
+
+def _get_cached_credentials(refresh_token: str, min_ttl: float) -> Credentials | None:
+    with _token_cache_lock:
+        creds = _token_cache.get(refresh_token)
+    if creds and _expiry_epoch(creds) - time.time() > min_ttl:
+        return creds
+    return None
+
+
+def refresh_user_tokens(refresh_token: str) -> Credentials:
+    """Refresh Google OAuth tokens, returning credentials with their expiry set."""
+    # Only the refresh grant itself; no stale access token is sent
     data = {
         "client_id": GOOGLE_CLIENT_ID,
         "client_secret": GOOGLE_CLIENT_SECRET,
@@ -12,30 +75,104 @@ def always_refresh_user_tokens(refresh_token: str) -> Credentials:
         "grant_type": "refresh_token"
     }
     try:
-        response = requests.post(token_url, data=data)
+        response = _session.post(TOKEN_URL, data=data, timeout=TOKEN_REQUEST_TIMEOUT)
+        # Decode the body once and reuse it for both the success and error paths
+        try:
+            tokens = orjson.loads(response.content)
+        except ValueError:
+            tokens = None
         if response.status_code != 200:
-            error_details = response.text
-            try:
-                error_json = response.json()
-                error_msg = f"HTTP {response.status_code}: {error_json.get('error', 'Unknown error')}"
-                if 'error_description' in error_json:
-                    error_msg += f" - {error_json['error_description']}"
-            except:
-                error_msg = f"HTTP {response.status_code}: {error_details}"
+            if isinstance(tokens, dict):
+                error_msg = f"HTTP {response.status_code}: {tokens.get('error', 'Unknown error')}"
+                if 'error_description' in tokens:
+                    error_msg += f" - {tokens['error_description']}"
+                if tokens.get('error') == "invalid_grant":
+                    raise InvalidGrantError(f"Failed to refresh token: {error_msg}")
+            else:
+                error_msg = f"HTTP {response.status_code}: {response.content.decode('utf-8', 'replace')}"
             raise Exception(f"Failed to refresh token: {error_msg}")
-        tokens = response.json()
+        if not isinstance(tokens, dict):
+            raise Exception("Invalid token response received from Google")
         access_token = tokens.get("access_token")
         if not access_token:
             raise Exception("No access token received from Google")
+        expires_in = int(tokens.get("expires_in", 3600))
         new_refresh_token = tokens.get("refresh_token", refresh_token)
         creds = Credentials(
             token=access_token,
             refresh_token=new_refresh_token,
-            token_uri=token_url,
+            token_uri=TOKEN_URL,
             client_id=GOOGLE_CLIENT_ID,
             client_secret=GOOGLE_CLIENT_SECRET,
-            scopes=["https://www.googleapis.com/auth/analytics.readonly"]
+            scopes=SCOPES,
+            # google-auth compares against naive UTC; with an expiry set it
+            # refreshes on its own only within its refresh threshold of it
+            expiry=datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=expires_in)
         )
         return creds
     except requests.RequestException as e:
-        raise Exception(f"Network error while refreshing token: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Network error while refreshing token: {str(e)}")
+
+
+def get_credentials_expiry(refresh_token: str) -> float | None:
+    """Return the epoch expiry of the cached access token for this refresh token, if any."""
+    with _token_cache_lock:
+        creds = _token_cache.get(refresh_token)
+    return _expiry_epoch(creds) if creds else None
+
+
+def get_valid_credentials(refresh_token: str, min_ttl: float = EXPIRY_MARGIN_SECONDS) -> Credentials:
+    """
+    Return cached Google OAuth credentials, refreshing them only when they
+    expire within `min_ttl` seconds.
+    """
+    creds = _get_cached_credentials(refresh_token, min_ttl)
+    if creds:
+        return creds
+
+    # One refresh per token at a time; waiters pick up the winner's result
+    with _get_token_lock(refresh_token):
+        creds = _get_cached_credentials(refresh_token, min_ttl)
+        if creds:
+            return creds
+        try:
+            creds = refresh_user_tokens(refresh_token)
+        except InvalidGrantError:
+            # Another worker may have rotated the token moments ago; its
+            # still-valid access token is better than failing the request
+            creds = _get_cached_credentials(refresh_token, 0)
+            if creds:
+                return creds
+            with _token_cache_lock:
+                _token_cache.pop(refresh_token, None)
+            raise
+        with _token_cache_lock:
+            previous = _token_cache.get(refresh_token)
+            if previous and creds.refresh_token == refresh_token:
+                # Update in place so GA4 clients built on these credentials stay usable
+                previous.token = creds.token
+                previous.expiry = creds.expiry
+                creds = previous
+            _token_cache[refresh_token] = creds
+            if creds.refresh_token != refresh_token:
+                _token_cache[creds.refresh_token] = creds
+        return creds
+
+
+async def get_valid_credentials_async(refresh_token: str, min_ttl: float = EXPIRY_MARGIN_SECONDS) -> Credentials:
+    """
+    Async variant of `get_valid_credentials` that keeps the token POST off the
+    event loop. Cached credentials are returned directly.
+    """
+    creds = _get_cached_credentials(refresh_token, min_ttl)
+    if creds:
+        return creds
+    
+    # Concurrent callers share one refresh instead of each tying up a thread
+    # waiting on the per-token lock
+    task = _inflight_refreshes.get(refresh_token)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(get_valid_credentials, refresh_token, min_ttl))
+        _inflight_refreshes[refresh_token] = task
+        task.add_done_callback(lambda _: _inflight_refreshes.pop(refresh_token, None))
+    return await asyncio.shield(task)
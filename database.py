@@ -1,18 +1,74 @@
-from supabase import create_client, Client
+import asyncio
+import threading
+from cachetools import TTLCache
+import httpx
+from supabase import create_client, Client, ClientOptions
 from config import SUPABASE_URL, SUPABASE_KEY
 
+# Connection pool shared by all credential lookups (they run in worker threads)
+POSTGREST_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+POSTGREST_TIMEOUT = httpx.Timeout(5.0, connect=2.0)
+
+# PostgREST builds full URLs and sets the auth headers on each request, so
+# the pooled client needs no base URL or headers of its own
+_http_client = httpx.Client(
+    http2=True,
+    limits=POSTGREST_LIMITS,
+    timeout=POSTGREST_TIMEOUT,
+    follow_redirects=True
+)
+
 # Initialize Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=_http_client))
+
+# user_id -> (refresh_token, property_id); connections only change on reconnect
+_credentials_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+_credentials_cache_lock = threading.Lock()
+
+def _get_cached_user_credentials(user_id: str):
+    with _credentials_cache_lock:
+        return _credentials_cache.get(user_id)
 
 def get_user_credentials(user_id: str):
+    """Get user credentials, served from a short-lived cache in front of Supabase."""
+    cached = _get_cached_user_credentials(user_id)
+    if cached:
+        return cached
+    credentials = _fetch_user_credentials(user_id)
+    with _credentials_cache_lock:
+        _credentials_cache[user_id] = credentials
+    return credentials
+
+def invalidate_user_credentials(user_id: str) -> None:
+    """Drop a user's cached credentials so the next lookup hits Supabase."""
+    with _credentials_cache_lock:
+        _credentials_cache.pop(user_id, None)
+
+def _fetch_user_credentials(user_id: str):
     """Get user credentials from Supabase database."""
-    response = supabase.table("user_ga_connections").select("refresh_token, property_id").eq("user_id", user_id).execute()
-    if response.data:
-        # Filter for rows with a non-null property_id
-        valid_rows = [row for row in response.data if row["property_id"]]
-        if not valid_rows:
-            raise Exception(f"No property_id found for user {user_id}")
-        first = valid_rows[0]
-        return first["refresh_token"], first["property_id"]
-    else:
-        raise Exception(f"User {user_id} not found in Supabase.")
\ No newline at end of file
+    # Let PostgREST skip rows without a (non-empty) property_id and return at most one row
+    response = (
+        supabase.table("user_ga_connections")
+        .select("refresh_token, property_id")
+        .eq("user_id", user_id)
+        .not_.is_("property_id", "null")
+        .neq("property_id", "")
+        .limit(1)
+        .maybe_single()
+        .execute()
+    )
+    # Depending on the postgrest version, no match is either None or empty data
+    row = response.data if response else None
+    if not row:
+        raise Exception(f"No GA4 connection with a property_id found for user {user_id} in Supabase.")
+    return row["refresh_token"], row["property_id"]
+
+async def get_user_credentials_async(user_id: str):
+    """
+    Async variant of `get_user_credentials` that runs the Supabase query in a
+    worker thread. Cache hits are answered without one.
+    """
+    cached = _get_cached_user_credentials(user_id)
+    if cached:
+        return cached
+    return await asyncio.to_thread(get_user_credentials, user_id)
@@ -1,27 +1,360 @@
+# The GA4 SDK is imported eagerly: importing any of its types loads the whole
+# package (client, gRPC and every message class) anyway, and main imports
+# this module in a background thread as the server starts, not at import.
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
-from google.analytics.data_v1beta.types import RunReportRequest, DateRange, Dimension, Metric, GetMetadataRequest, FilterExpression, Filter
+from google.analytics.data_v1beta.services.beta_analytics_data.transports import BetaAnalyticsDataGrpcTransport
+from google.analytics.data_v1beta.types import RunReportRequest, BatchRunReportsRequest, DateRange, Dimension, Metric, GetMetadataRequest, FilterExpression, MetricType, Filter, OrderBy, RunReportResponse
 from models import GA4QueryInput, BasicQueryInput
-from database import get_user_credentials
-from auth import always_refresh_user_tokens
+from database import get_user_credentials_async, invalidate_user_credentials
+from auth import get_valid_credentials_async, get_credentials_expiry, InvalidGrantError, EXPIRY_MARGIN_SECONDS
+from cachetools import TLRUCache, TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from functools import lru_cache, partial
+from typing import NamedTuple
+import asyncio
+import base64
+import grpc
+import json
 import logging
-import traceback
+import sys
+import time
+import weakref
 
 logger = logging.getLogger(__name__)
 
-def parse_simple_filters(filter_dict: dict) -> FilterExpression:
+# user_id -> refresh token from the last Supabase lookup, so the token refresh
+# can start before the lookup confirms it
+_known_refresh_tokens: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+# Tokens of active users are renewed this long before they expire, so warm
+# requests never wait on the token endpoint. This is earlier than requests
+# (and google-auth itself) would refresh them. Each request re-arms the
+# renewal, so idle users stop being renewed after one more cycle.
+TOKEN_RENEW_AHEAD_SECONDS = EXPIRY_MARGIN_SECONDS + 15
+_renewal_tasks: dict[str, asyncio.Task] = {}
+
+# refresh_token -> (credentials, client); reusing the client keeps its gRPC
+# channel open, and refreshed tokens are written into the same credentials
+_client_cache: TTLCache = TTLCache(maxsize=512, ttl=3000)
+
+# Reports that include the last two days can still change as GA4 processes
+# new data; older ones are final and can be cached for much longer
+RECENT_REPORT_TTL_SECONDS = 60
+HISTORICAL_REPORT_TTL_SECONDS = 24 * 3600
+
+class ReportKey(NamedTuple):
+    """Identifies a report by the requesting user and everything that affects its result."""
+    user_id: str
+    property_id: str
+    dimensions: tuple
+    metrics: tuple
+    start_date: str
+    end_date: str
+    limit: int | None
+    filters: str
+    order_by: str
+    currency_code: str | None
+    granularity: str | None
+    include_empty_rows: bool | None
+    split_by_date: bool | None
+    response_format: str
+
+def _report_expiry(key: ReportKey, result: dict, now: float) -> float:
+    end_date = key.end_date
+    settled_before = (date.today() - timedelta(days=1)).isoformat()
+    if end_date < settled_before:
+        return now + HISTORICAL_REPORT_TTL_SECONDS
+    return now + RECENT_REPORT_TTL_SECONDS
+
+# Successful report results by user and query, and the queries currently running
+_result_cache: TLRUCache = TLRUCache(maxsize=256, ttu=_report_expiry)
+_inflight_reports: dict[ReportKey, asyncio.Task] = {}
+
+# property_id -> (dimensions, metrics) as returned by list_ga4_metadata
+_metadata_cache: TTLCache = TTLCache(maxsize=512, ttl=3600)
+
+class GA4Error(Exception):
+    """Base for failures reported back to the caller as an unsuccessful result."""
+    # Prefix of the error message returned to the caller
+    message: str | None = None
+    # Unexpected failures are logged with their traceback
+    log_traceback = False
+
+class QueryError(GA4Error):
+    """Raised when a query cannot be run as specified."""
+
+class CredentialsError(GA4Error):
+    """Raised when a user's GA4 connection cannot be loaded from Supabase."""
+    message = "Failed to retrieve user credentials"
+
+class TokenRefreshError(GA4Error):
+    """Raised when a user's Google OAuth tokens cannot be refreshed."""
+    message = "Failed to refresh authentication tokens"
+
+class ClientBuildError(GA4Error):
+    """Raised when a GA4 client cannot be created for the user."""
+    message = "Failed to create GA4 client"
+
+class FilterError(GA4Error):
+    """Raised when a query's filters cannot be turned into a FilterExpression."""
+    message = "Invalid filters format"
+
+class RequestBuildError(GA4Error):
+    """Raised when a query cannot be turned into a RunReportRequest."""
+    message = "Failed to build GA4 request"
+    log_traceback = True
+
+class GA4ApiError(GA4Error):
+    """Raised when the GA4 Data API rejects or fails a report."""
+    message = "GA4 API request failed"
+    log_traceback = True
+
+class ResponseProcessingError(GA4Error):
+    """Raised when a GA4 report cannot be converted into the response format."""
+    message = "Failed to process GA4 response"
+    log_traceback = True
+
+def _error_result(error: GA4Error) -> dict:
+    return {
+        "success": False,
+        "error": f"{error.message}: {error}" if error.message else str(error),
+        "data": [],
+        "rowCount": 0
+    }
+
+async def get_authenticated_client(user_id: str) -> tuple[BetaAnalyticsDataClient, str]:
     """
-    Converts a dict like {"field_name": "value"} to a GA4 FilterExpression
+    Build a GA4 client for the user and return it with their default property ID.
+
+    The Supabase lookup and the token refresh run concurrently when the user's
+    refresh token is already known; the refresh is redone if Supabase returns
+    a different token.
     """
-    expressions = []
-    for key, value in filter_dict.items():
-        expressions.append(
-            FilterExpression(
-                filter=Filter(
-                    field_name=key,
-                    string_filter=Filter.StringFilter(value=value)
+    known_token = _known_refresh_tokens.get(user_id)
+    lookups = [get_user_credentials_async(user_id)]
+    if known_token:
+        lookups.append(get_valid_credentials_async(known_token))
+    row, *prefetched = await asyncio.gather(*lookups, return_exceptions=True)
+    
+    if isinstance(row, Exception):
+        raise CredentialsError(str(row)) from row
+    refresh_token, property_id = row
+    _known_refresh_tokens[user_id] = refresh_token
+    logger.info("Retrieved credentials for user %s, property: %s", user_id, property_id)
+    
+    try:
+        creds = None
+        if prefetched and refresh_token == known_token:
+            creds = prefetched[0]
+            if isinstance(creds, Exception):
+                raise creds
+        if creds is None:
+            creds = await get_valid_credentials_async(refresh_token)
+    except InvalidGrantError as e:
+        # The stored token was revoked or replaced; re-read it on the next call
+        invalidate_user_credentials(user_id)
+        _known_refresh_tokens.pop(user_id, None)
+        raise TokenRefreshError(str(e)) from e
+    except Exception as e:
+        raise TokenRefreshError(str(e)) from e
+    logger.info("Obtained valid user tokens")
+    _schedule_token_renewal(creds.refresh_token)
+    
+    try:
+        client = _get_client(refresh_token, creds)
+    except Exception as e:
+        raise ClientBuildError(str(e)) from e
+    return client, property_id
+
+def _schedule_token_renewal(refresh_token: str) -> None:
+    """Renew the token shortly before it expires, unless a renewal is already pending."""
+    if refresh_token in _renewal_tasks:
+        return
+    expiry = get_credentials_expiry(refresh_token)
+    if expiry is None:
+        return
+    delay = expiry - TOKEN_RENEW_AHEAD_SECONDS - time.time()
+    task = asyncio.ensure_future(_renew_token(refresh_token, delay))
+    _renewal_tasks[refresh_token] = task
+    task.add_done_callback(lambda _: _renewal_tasks.pop(refresh_token, None))
+
+async def _renew_token(refresh_token: str, delay: float) -> None:
+    await asyncio.sleep(max(delay, 0))
+    try:
+        # The cached credentials object is updated in place, so clients keep working
+        await get_valid_credentials_async(refresh_token, min_ttl=TOKEN_RENEW_AHEAD_SECONDS)
+        logger.info("Renewed user tokens ahead of expiry")
+    except Exception as e:
+        logger.warning("Background token renewal failed: %s", e)
+
+# Keep pinging during long-running reports so dead connections are noticed
+# quickly, on top of the transport's own message size options
+GA4_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+def _create_ga4_channel(host: str, options=(), **kwargs) -> grpc.Channel:
+    """
+    Create the GA4 gRPC channel with gzip-compressed messages (gRPC already
+    advertises gzip, so GA4 can compress its large report responses too).
+    """
+    return BetaAnalyticsDataGrpcTransport.create_channel(
+        host,
+        options=[*options, *GA4_CHANNEL_OPTIONS],
+        compression=grpc.Compression.Gzip,
+        **kwargs
+    )
+
+def _get_client(refresh_token: str, creds) -> BetaAnalyticsDataClient:
+    """Return the cached GA4 client for these credentials, creating it if needed."""
+    cached = _client_cache.get(refresh_token)
+    if cached and cached[0] is creds:
+        return cached[1]
+    transport = BetaAnalyticsDataGrpcTransport(credentials=creds, channel=_create_ga4_channel)
+    client = BetaAnalyticsDataClient(transport=transport)
+    _client_cache[refresh_token] = (creds, client)
+    return client
+
+# Blocking GA4 gRPC calls get their own threads so slow reports can't starve
+# the default executor used for token refreshes and Supabase lookups
+GA4_RPC_WORKERS = 32
+_ga4_executor = ThreadPoolExecutor(max_workers=GA4_RPC_WORKERS, thread_name_prefix="ga4-rpc")
+
+# GA4 allows this many concurrent requests per property. Every RPC for a
+# property, from any tool call, waits on that property's semaphore; it is
+# only referenced while calls hold or wait on it, so idle properties drop out.
+GA4_MAX_CONCURRENT_REQUESTS = 10
+_property_limiters: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+async def _call_ga4(property_id: str, method, *args):
+    """
+    Run a blocking GA4 client method on the GA4 executor and await its
+    result, within the property's concurrent request limit.
+    """
+    limiter = _property_limiters.get(property_id)
+    if limiter is None:
+        limiter = _property_limiters[property_id] = asyncio.Semaphore(GA4_MAX_CONCURRENT_REQUESTS)
+    async with limiter:
+        return await asyncio.get_running_loop().run_in_executor(_ga4_executor, partial(method, *args))
+
+# Granularity names accepted in GA4QueryInput and the date dimension each maps to
+GRANULARITY_DIMENSIONS = {
+    "daily": "date",
+    "weekly": "week",
+    "monthly": "month"
+}
+
+# Reports asking for more rows than this are fetched in concurrent offset
+# pages, within the property's concurrent request limit
+REPORT_PAGE_SIZE = 2500
+
+# With split_by_date, reports broken down by date over more than
+# DATE_SPLIT_MIN_DAYS days and asking for more than DATE_SPLIT_MIN_LIMIT rows
+# are run as up to DATE_SPLIT_MAX_RANGES parallel queries over shorter date
+# ranges. Each sub-range costs its own GA4 quota, so this is opt-in.
+DATE_SPLIT_MIN_DAYS = 30
+DATE_SPLIT_MIN_LIMIT = 1000
+DATE_SPLIT_MAX_RANGES = 4
+
+# GA4 accepts at most this many reports in one batchRunReports call
+MAX_BATCH_REPORTS = 5
+
+class ReportCoalescer:
+    """
+    Merges run_report calls for the same client and property that arrive
+    within a short window into one batchRunReports RPC, DataLoader-style.
+    """
+    def __init__(self, window: float = 0.005):
+        self.window = window
+        self._pending: dict[tuple, list] = {}
+        self._flushes: set[asyncio.Task] = set()
+
+    async def run_report(self, client: BetaAnalyticsDataClient, property_id: str, request: RunReportRequest):
+        key = (id(client), property_id)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            loop.call_later(self.window, self._schedule_flush, key, batch, client, property_id)
+        batch.append((request, future))
+        if len(batch) >= MAX_BATCH_REPORTS:
+            self._schedule_flush(key, batch, client, property_id)
+        return await future
+
+    def _schedule_flush(self, key, batch, client, property_id):
+        # A full batch is flushed early, so its timer may find it already gone
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        task = asyncio.ensure_future(self._flush(batch, client, property_id))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch, client, property_id):
+        if len(batch) > 1:
+            try:
+                response = await _call_ga4(property_id, client.batch_run_reports, BatchRunReportsRequest(
+                    property=f"properties/{property_id}",
+                    requests=[request for request, _ in batch]
+                ))
+                for (_, future), report in zip(batch, response.reports):
+                    if not future.done():
+                        future.set_result(report)
+                if len(response.reports) == len(batch):
+                    logger.info("Coalesced %s reports into one batchRunReports call", len(batch))
+                    return
+                # Callers past the last report would never be answered otherwise
+                logger.warning(
+                    "batchRunReports returned %s of %s reports, running the rest individually",
+                    len(response.reports), len(batch)
                 )
-            )
+            except Exception as e:
+                # One invalid report fails the whole batch; retry individually
+                # so it doesn't take the other callers down with it
+                logger.warning("batchRunReports failed, running reports individually: %s", e)
+        pending = [(request, future) for request, future in batch if not future.done()]
+        responses = await asyncio.gather(
+            *(_call_ga4(property_id, client.run_report, request) for request, _ in pending),
+            return_exceptions=True
+        )
+        for (_, future), response in zip(pending, responses):
+            if future.done():
+                continue
+            if isinstance(response, Exception):
+                future.set_exception(response)
+            else:
+                future.set_result(response)
+
+_report_coalescer = ReportCoalescer()
+
+# Requests copy these on assignment, so one shared message per name is safe
+@lru_cache(maxsize=128)
+def _dim(name: str) -> Dimension:
+    return Dimension(name=name)
+
+@lru_cache(maxsize=128)
+def _metric(name: str) -> Metric:
+    return Metric(name=name)
+
+@lru_cache(maxsize=1024)
+def _string_filter_expression(field_name: str, value: str) -> FilterExpression:
+    """Build (once per field/value pair) an exact-match string filter."""
+    return FilterExpression(
+        filter=Filter(
+            field_name=field_name,
+            string_filter=Filter.StringFilter(value=value)
         )
+    )
+
+def parse_simple_filters(filter_dict: dict) -> FilterExpression:
+    """
+    Converts a dict like {"field_name": "value"} to a GA4 FilterExpression
+    """
+    expressions = [_string_filter_expression(key, value) for key, value in filter_dict.items()]
     
     if len(expressions) == 1:
         return expressions[0]
@@ -30,6 +363,20 @@ def parse_simple_filters(filter_dict: dict) -> FilterExpression:
         and_group={"expressions": expressions}
     )
 
+def _build_order_by(order: dict) -> OrderBy | None:
+    """Convert an order_by clause from the input into a GA4 OrderBy, or None if unrecognised."""
+    if "metric" in order:
+        return OrderBy(
+            metric=OrderBy.MetricOrderBy(metric_name=order["metric"]["metric_name"]),
+            desc=order.get("desc", False)
+        )
+    if "dimension" in order:
+        return OrderBy(
+            dimension=OrderBy.DimensionOrderBy(dimension_name=order["dimension"]["dimension_name"]),
+            desc=order.get("desc", False)
+        )
+    return None
+
 def build_filter_expression(filters: dict) -> FilterExpression | None:
     """
     Build a proper FilterExpression from the input filters
@@ -37,230 +384,172 @@ def build_filter_expression(filters: dict) -> FilterExpression | None:
     if not filters:
         return None
     
-    # Check if it's already a properly structured filter expression
-    if "dimension_filter" in filters:
-        # Handle the nested structure from your query
-        filter_config = filters["dimension_filter"]
-        if "filter" in filter_config:
-            filter_def = filter_config["filter"]
-            return FilterExpression(
-                filter=Filter(
-                    field_name=filter_def["field_name"],
-                    string_filter=Filter.StringFilter(value=filter_def["string_filter"]["value"])
-                )
-            )
+    # Dashboards resend identical filters, so cache on a canonical form
+    return _build_filter_expression_cached(json.dumps(filters, sort_keys=True))
+
+@lru_cache(maxsize=1024)
+def _build_filter_expression_cached(canonical_filters: str) -> FilterExpression:
+    filters = json.loads(canonical_filters)
     
-    # Handle direct filter specification
-    if "filter" in filters:
-        filter_def = filters["filter"]
-        return FilterExpression(
-            filter=Filter(
-                field_name=filter_def["field_name"],
-                string_filter=Filter.StringFilter(value=filter_def["string_filter"]["value"])
-            )
-        )
+    # Nested structure from your query ({"dimension_filter": {"filter": ...}})
+    # or a direct filter specification ({"filter": ...})
+    filter_def = (filters.get("dimension_filter") or {}).get("filter") or filters.get("filter")
+    if filter_def:
+        return _string_filter_expression(filter_def["field_name"], filter_def["string_filter"]["value"])
     
     # Handle simple key-value filters
     return parse_simple_filters(filters)
 
+def _split_date_range(start: date, end: date, chunks: int) -> list[tuple[date, date]]:
+    """Split the inclusive range [start, end] into `chunks` contiguous sub-ranges of near-equal length."""
+    days = (end - start).days + 1
+    bounds = [start + timedelta(days=days * i // chunks) for i in range(chunks + 1)]
+    return [(bounds[i], bounds[i + 1] - timedelta(days=1)) for i in range(chunks)]
+
+def _date_split_ranges(request: RunReportRequest, limit: int | None) -> list[tuple[date, date]] | None:
+    """
+    Return the sub-ranges to run a report over in parallel, or None to run it
+    as one query. Only reports broken down by `date` without an explicit
+    order can be split: every row then belongs to exactly one sub-range, so
+    as long as no sub-report is cut off by the limit, concatenating them
+    gives the same rows as the full range.
+    """
+    if not limit or limit <= DATE_SPLIT_MIN_LIMIT or request.order_bys or request.offset:
+        return None
+    if "date" not in [d.name for d in request.dimensions] or len(request.date_ranges) != 1:
+        return None
+    start = date.fromisoformat(request.date_ranges[0].start_date)
+    end = date.fromisoformat(request.date_ranges[0].end_date)
+    days = (end - start).days + 1
+    if days <= DATE_SPLIT_MIN_DAYS:
+        return None
+    return _split_date_range(start, end, min(DATE_SPLIT_MAX_RANGES, -(-days // DATE_SPLIT_MIN_DAYS)))
+
+async def _fetch_report(client: BetaAnalyticsDataClient, property_id: str, request: RunReportRequest, limit: int | None, split_by_date: bool = False):
+    """
+    Run a report, splitting long date-broken-down reports into concurrent
+    date sub-ranges when asked to, and paginating other large ones.
+    """
+    sub_ranges = _date_split_ranges(request, limit) if split_by_date else None
+    if sub_ranges is None:
+        return await _run_paginated_report(client, property_id, request, limit)
+    
+    async def fetch_range(start: date, end: date):
+        range_request = RunReportRequest(request)
+        range_request.date_ranges = [DateRange(start_date=start.isoformat(), end_date=end.isoformat())]
+        return await _call_ga4(property_id, client.run_report, range_request)
+    
+    reports = await asyncio.gather(*(fetch_range(start, end) for start, end in sub_ranges))
+    total = sum(report.row_count for report in reports)
+    if total > limit:
+        # The full report would be cut to a different subset of rows than
+        # the sub-reports, so only the unsplit query gives the right answer
+        logger.info("Date sub-ranges hold %s rows, over the limit of %s; running the report unsplit", total, limit)
+        return await _run_paginated_report(client, property_id, request, limit)
+    date_idx = [d.name for d in request.dimensions].index("date")
+    rows = sorted(
+        (row for report in reports for row in RunReportResponse.pb(report).rows),
+        key=lambda row: row.dimension_values[date_idx].value
+    )
+    # Carry the first report's headers and metadata with no rows of its own,
+    # so callers append the merged rows just like they do for later pages
+    first = RunReportResponse.pb(reports[0])
+    merged = type(first)()
+    merged.CopyFrom(first)
+    merged.ClearField("rows")
+    merged.row_count = total
+    logger.info("Fetched %s rows over %s date sub-ranges", len(rows), len(sub_ranges))
+    return RunReportResponse.wrap(merged), rows
+
+async def _run_paginated_report(client: BetaAnalyticsDataClient, property_id: str, request: RunReportRequest, limit: int | None):
+    """
+    Run a report, fetching it in concurrent offset pages when the requested
+    limit is larger than one page. Returns the first page's response (for
+    headers and metadata) and the rows of all pages in order, as raw protobuf
+    Row messages: reading cells through them skips proto-plus's per-access
+    wrapping, which dominates converting large reports.
+    """
+    if not limit or limit <= REPORT_PAGE_SIZE:
+        response = await _report_coalescer.run_report(client, property_id, request)
+        return response, list(RunReportResponse.pb(response).rows)
+    
+    # The first page tells us how many rows there are in total
+    first = await _report_coalescer.run_report(
+        client, property_id, RunReportRequest(request, offset=0, limit=REPORT_PAGE_SIZE)
+    )
+    total = min(limit, first.row_count)
+    offsets = range(REPORT_PAGE_SIZE, total, REPORT_PAGE_SIZE)
+    
+    async def fetch_page(offset: int):
+        page_request = RunReportRequest(request, offset=offset, limit=min(REPORT_PAGE_SIZE, total - offset))
+        return await _call_ga4(property_id, client.run_report, page_request)
+    
+    pages = await asyncio.gather(*(fetch_page(offset) for offset in offsets))
+    rows = list(RunReportResponse.pb(first).rows)
+    for page in pages:
+        rows.extend(RunReportResponse.pb(page).rows)
+    if pages:
+        logger.info("Fetched %s rows in %s pages", len(rows), len(pages) + 1)
+    return first, rows
+
+def _encode_report_response(response: RunReportResponse, rows: list) -> str:
+    """Serialize a report (with the rows of every page) as base64 RunReportResponse bytes."""
+    pb = RunReportResponse.pb(response)
+    # Later pages' (or date sub-ranges') rows are appended to the first response
+    pb.rows.extend(rows[len(pb.rows):])
+    return base64.b64encode(pb.SerializeToString()).decode("ascii")
+
+@lru_cache(maxsize=None)
+def _metric_parser(metric_type: MetricType):
+    """
+    Return the converter for values of a GA4 metric type: integers for
+    TYPE_INTEGER, floats for every other numeric type. Empty or unparsable
+    values are passed through as GA4 sent them.
+    """
+    if metric_type == MetricType.METRIC_TYPE_UNSPECIFIED:
+        return str
+    parse = int if metric_type == MetricType.TYPE_INTEGER else float
+    
+    def convert(value: str):
+        if not value:
+            return value
+        try:
+            return parse(value)
+        except ValueError:
+            return value
+    return convert
+
+def _sum_counts(values) -> int:
+    """Sum integer metric values, skipping values that don't parse."""
+    total = 0
+    for value in values:
+        try:
+            total += int(value)
+        except (ValueError, TypeError):
+            pass
+    return total
+
 async def get_ga4_data(input: GA4QueryInput) -> dict:
     """
     Query Google Analytics 4 data with specific dimensions and metrics.
     """
     try:
-        logger.info(f"Starting GA4 data query for user: {input.user_id}")
+        logger.info("Starting GA4 data query for user: %s", input.user_id)
         
-        # Get user credentials
-        try:
-            refresh_token, property_id = get_user_credentials(input.user_id)
-            logger.info(f"Retrieved credentials for user {input.user_id}, property: {property_id}")
-        except Exception as e:
-            logger.error(f"Failed to get user credentials: {str(e)}")
-            return {
-                "success": False,
-                "error": f"Failed to retrieve user credentials: {str(e)}",
-                "data": [],
-                "rowCount": 0
-            }
+        client, property_id = await get_authenticated_client(input.user_id)
+        logger.info("Created GA4 client successfully")
         
         # Override property ID if provided
         if input.property_id:
             property_id = input.property_id
-            logger.info(f"Using override property ID: {property_id}")
-        
-        # Refresh tokens
-        try:
-            creds = always_refresh_user_tokens(refresh_token)
-            logger.info("Successfully refreshed user tokens")
-        except Exception as e:
-            logger.error(f"Failed to refresh tokens: {str(e)}")
-            return {
-                "success": False,
-                "error": f"Failed to refresh authentication tokens: {str(e)}",
-                "data": [],
-                "rowCount": 0
-            }
-        
-        # Create GA4 client
-        try:
-            client = BetaAnalyticsDataClient(credentials=creds)
-            logger.info("Created GA4 client successfully")
-        except Exception as e:
-            logger.error(f"Failed to create GA4 client: {str(e)}")
-            return {
-                "success": False,
-                "error": f"Failed to create GA4 client: {str(e)}",
-                "data": [],
-                "rowCount": 0
-            }
-        
-        # Validate inputs
-        if not input.dimensions and not input.metrics:
-            return {
-                "success": False,
-                "error": "At least one dimension or metric must be specified",
-                "data": [],
-                "rowCount": 0
-            }
-        
-        # Build the request
-        try:
-            dimensions = [Dimension(name=d) for d in input.dimensions]
-            
-            # Handle granularity as a dimension if provided and not already in dimensions
-            if input.granularity and input.granularity not in input.dimensions:
-                granularity_map = {
-                    "daily": "date",
-                    "weekly": "week",
-                    "monthly": "month"
-                }
-                gran_dim = granularity_map.get(input.granularity.lower(), input.granularity)
-                if gran_dim not in [d.name for d in dimensions]:
-                    dimensions.append(Dimension(name=gran_dim))
-
-            # Build filters properly
-            dimension_filter = None
-            if input.filters:
-                try:
-                    dimension_filter = build_filter_expression(input.filters)
-                    logger.info(f"Built dimension filter: {dimension_filter}")
-                except Exception as e:
-                    logger.error(f"Failed to parse filters: {str(e)}")
-                    return {
-                        "success": False,
-                        "error": f"Invalid filters format: {str(e)}",
-                        "data": [],
-                        "rowCount": 0
-                    }
-
-            # Build order_bys
-            order_bys = []
-            if input.order_by:
-                for order in input.order_by:
-                    if "metric" in order:
-                        from google.analytics.data_v1beta.types import OrderBy
-                        order_bys.append(OrderBy(
-                            metric=OrderBy.MetricOrderBy(metric_name=order["metric"]["metric_name"]),
-                            desc=order.get("desc", False)
-                        ))
-                    elif "dimension" in order:
-                        from google.analytics.data_v1beta.types import OrderBy
-                        order_bys.append(OrderBy(
-                            dimension=OrderBy.DimensionOrderBy(dimension_name=order["dimension"]["dimension_name"]),
-                            desc=order.get("desc", False)
-                        ))
-
-            request = RunReportRequest(
-                property=f"properties/{property_id}",
-                dimensions=dimensions,
-                metrics=[Metric(name=m) for m in input.metrics],
-                date_ranges=[DateRange(start_date=input.start_date, end_date=input.end_date)],
-                limit=input.limit,
-                currency_code=input.currency_code if input.currency_code else None,
-                keep_empty_rows=input.include_empty_rows if input.include_empty_rows is not None else None,
-                dimension_filter=dimension_filter,
-                order_bys=order_bys if order_bys else None
-            )
-            
-            logger.info(f"Built request - Property: {property_id}, Dimensions: {[d.name for d in dimensions]}, Metrics: {input.metrics}")
-            
-        except Exception as e:
-            logger.error(f"Failed to build request: {str(e)}")
-            logger.error(f"Request build traceback: {traceback.format_exc()}")
-            return {
-                "success": False,
-                "error": f"Failed to build GA4 request: {str(e)}",
-                "data": [],
-                "rowCount": 0
-            }
-        
-        # Execute the request
-        try:
-            logger.info("Executing GA4 request...")
-            response = client.run_report(request)
-            logger.info(f"GA4 request completed successfully, got {len(response.rows)} rows")
-        except Exception as e:
-            logger.error(f"GA4 API request failed: {str(e)}")
-            logger.error(f"API request traceback: {traceback.format_exc()}")
-            return {
-                "success": False,
-                "error": f"GA4 API request failed: {str(e)}",
-                "data": [],
-                "rowCount": 0
-            }
+            logger.info("Using override property ID: %s", property_id)
         
-        # Convert response to readable format
-        try:
-            rows = []
-            total_sessions = 0  # Track total for aggregation
-            
-            for row in response.rows:
-                row_data = {}
-                # Add dimensions
-                for i, dim_value in enumerate(row.dimension_values):
-                    dim_name = response.dimension_headers[i].name
-                    row_data[dim_name] = dim_value.value
-                
-                # Add metrics
-                for i, metric_value in enumerate(row.metric_values):
-                    metric_name = response.metric_headers[i].name
-                    value = metric_value.value
-                    row_data[metric_name] = value
-                    
-                    # Sum sessions for total calculation
-                    if metric_name == "sessions":
-                        try:
-                            total_sessions += int(value)
-                        except (ValueError, TypeError):
-                            pass
-                
-                rows.append(row_data)
-            
-            logger.info(f"Successfully processed {len(rows)} rows, total sessions: {total_sessions}")
-            
-            return {
-                "success": True,
-                "data": rows,
-                "rowCount": len(rows),
-                "totalSessions": total_sessions,  # Add total for verification
-                "dimensions": input.dimensions,
-                "metrics": input.metrics,
-                "dateRange": f"{input.start_date} to {input.end_date}",
-                "propertyId": property_id
-            }
-        except Exception as e:
-            logger.error(f"Failed to process response: {str(e)}")
-            logger.error(f"Response processing traceback: {traceback.format_exc()}")
-            return {
-                "success": False,
-                "error": f"Failed to process GA4 response: {str(e)}",
-                "data": [],
-                "rowCount": 0
-            }
-            
+        return await _get_report_result(input, client, property_id)
+    except GA4Error as e:
+        logger.error("%s: %s", e.message or "GA4 query failed", e, exc_info=e.log_traceback)
+        return _error_result(e)
     except Exception as e:
-        logger.error(f"Unexpected error in get_ga4_data: {str(e)}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        logger.exception("Unexpected error in get_ga4_data: %s", e)
         return {
             "success": False,
             "error": f"Unexpected error: {str(e)}",
@@ -268,76 +557,269 @@ async def get_ga4_data(input: GA4QueryInput) -> dict:
             "rowCount": 0
         }
 
-async def list_ga4_dimensions(input: BasicQueryInput) -> dict:
-    """List all available GA4 dimensions for the user's property."""
+def _report_cache_key(input: GA4QueryInput, property_id: str) -> ReportKey:
+    return ReportKey(
+        # property_id can be overridden by the caller, and GA4 only checks
+        # access on a real request, so results are never shared across users
+        user_id=input.user_id,
+        property_id=property_id,
+        dimensions=tuple(input.dimensions),
+        metrics=tuple(input.metrics),
+        start_date=input.start_date,
+        end_date=input.end_date,
+        limit=input.limit,
+        filters=json.dumps(input.filters, sort_keys=True, default=str),
+        order_by=json.dumps(input.order_by, sort_keys=True, default=str),
+        currency_code=input.currency_code,
+        granularity=input.granularity,
+        include_empty_rows=input.include_empty_rows,
+        split_by_date=input.split_by_date,
+        response_format=input.response_format
+    )
+
+async def _get_report_result(input: GA4QueryInput, client: BetaAnalyticsDataClient, property_id: str) -> dict:
+    """
+    Run the report, sharing the result with the same user's identical
+    in-flight queries and serving their repeats from the result cache.
+    """
+    key = _report_cache_key(input, property_id)
+    cached = _result_cache.get(key)
+    if cached is not None:
+        logger.info("Serving cached GA4 report for property %s", property_id)
+        return cached
+    
+    task = _inflight_reports.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_run_report_query(input, client, property_id))
+        _inflight_reports[key] = task
+        task.add_done_callback(lambda t: _finish_report(key, t))
+    else:
+        logger.info("Joining in-flight GA4 report for property %s", property_id)
+    # Shield so one caller being cancelled doesn't cancel the shared query
+    return await asyncio.shield(task)
+
+def _finish_report(key: ReportKey, task: asyncio.Task) -> None:
+    _inflight_reports.pop(key, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    if result.get("success"):
+        _result_cache[key] = result
+
+async def _run_report_query(input: GA4QueryInput, client: BetaAnalyticsDataClient, property_id: str) -> dict:
+    """
+    Build, execute and convert a single GA4 report, raising a GA4Error
+    subclass naming the step that failed.
+    """
+    # Validate inputs
+    if not input.dimensions and not input.metrics:
+        raise QueryError("At least one dimension or metric must be specified")
+    
+    # Build filters properly
+    dimension_filter = None
+    if input.filters:
+        try:
+            dimension_filter = build_filter_expression(input.filters)
+        except Exception as e:
+            raise FilterError(str(e)) from e
+        logger.info("Built dimension filter: %s", dimension_filter)
+    
+    # Build the request
     try:
-        logger.info(f"Getting dimensions for user: {input.user_id}")
+        dimensions = [_dim(d) for d in input.dimensions]
         
-        refresh_token, property_id = get_user_credentials(input.user_id)
-        creds = always_refresh_user_tokens(refresh_token)
-        client = BetaAnalyticsDataClient(credentials=creds)
+        # Handle granularity as a dimension if provided and not already in dimensions
+        if input.granularity and input.granularity not in input.dimensions:
+            gran_dim = GRANULARITY_DIMENSIONS.get(input.granularity.lower(), input.granularity)
+            if gran_dim not in input.dimensions:
+                dimensions.append(_dim(gran_dim))
+
+        # Build order_bys
+        order_bys = [
+            order_by for order_by in (_build_order_by(order) for order in (input.order_by or ()))
+            if order_by is not None
+        ]
+
+        request = RunReportRequest(
+            property=f"properties/{property_id}",
+            dimensions=dimensions,
+            metrics=[_metric(m) for m in input.metrics],
+            date_ranges=[DateRange(start_date=input.start_date, end_date=input.end_date)],
+            limit=input.limit,
+            currency_code=input.currency_code if input.currency_code else None,
+            keep_empty_rows=input.include_empty_rows if input.include_empty_rows is not None else None,
+            dimension_filter=dimension_filter,
+            order_bys=order_bys if order_bys else None
+        )
+    except Exception as e:
+        raise RequestBuildError(str(e)) from e
+    
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Built request - Property: %s, Dimensions: %s, Metrics: %s", property_id, [d.name for d in dimensions], input.metrics)
+    
+    # Execute the request
+    try:
+        response, report_rows = await _fetch_report(client, property_id, request, input.limit, input.split_by_date)
+    except Exception as e:
+        raise GA4ApiError(str(e)) from e
+    logger.info("GA4 request completed successfully, got %s rows", len(report_rows))
+    
+    # Convert response to readable format
+    try:
+        # Interned so every row dict (and every cached result) shares one key object per header
+        dim_names = [sys.intern(h.name) for h in response.dimension_headers]
+        metric_names = [sys.intern(h.name) for h in response.metric_headers]
+        
+        headers = tuple(dim_names + metric_names)
+        row_count = len(report_rows)
         
-        metadata = client.get_metadata(GetMetadataRequest(name=f"properties/{property_id}/metadata"))
+        if input.response_format == "proto":
+            # Ship GA4's own wire format; no per-cell Python objects are built
+            data = _encode_report_response(response, report_rows)
+            session_values = ()
+            if "sessions" in metric_names:
+                sessions_idx = metric_names.index("sessions")
+                session_values = (row.metric_values[sessions_idx].value for row in report_rows)
+        else:
+            # Read every cell out of the protos exactly once, converting
+            # metrics to JSON numbers as they are read
+            parsers = [_metric_parser(h.type_) for h in response.metric_headers]
+            row_values = [
+                [v.value for v in row.dimension_values]
+                + [parse(v.value) for parse, v in zip(parsers, row.metric_values)]
+                for row in report_rows
+            ]
+            
+            if input.response_format == "compact":
+                # Rows as plain value lists; the keys are sent once, in "columns"
+                data = row_values
+            elif input.response_format == "columnar":
+                # One list per column instead of one dict per row
+                columns = zip(*row_values) if row_values else [()] * len(headers)
+                data = {name: list(column) for name, column in zip(headers, columns)}
+            else:
+                data = [dict(zip(headers, values)) for values in row_values]
+            
+            session_values = ()
+            if "sessions" in metric_names:
+                sessions_idx = len(dim_names) + metric_names.index("sessions")
+                session_values = (values[sessions_idx] for values in row_values)
         
-        dimensions = []
-        for d in metadata.dimensions:
-            dimensions.append({
-                "name": d.api_name,
-                "displayName": d.ui_name,
-                "description": d.description
-            })
+        # Sum sessions for total calculation (track total for aggregation)
+        total_sessions = _sum_counts(session_values)
         
-        logger.info(f"Retrieved {len(dimensions)} dimensions")
+        logger.info("Successfully processed %s rows, total sessions: %s", row_count, total_sessions)
         
-        return {
+        result = {
             "success": True,
-            "dimensions": dimensions,
-            "count": len(dimensions),
+            "data": data,
+            "rowCount": row_count,
+            "totalSessions": total_sessions,  # Add total for verification
+            "dimensions": input.dimensions,
+            "metrics": input.metrics,
+            "dateRange": f"{input.start_date} to {input.end_date}",
             "propertyId": property_id
         }
+        if input.response_format in ("compact", "columnar"):
+            result["columns"] = list(headers)
+        elif input.response_format == "proto":
+            result["messageType"] = RunReportResponse.pb().DESCRIPTOR.full_name
+        return result
     except Exception as e:
-        logger.error(f"Error in list_ga4_dimensions: {str(e)}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        return {
-            "success": False,
-            "error": str(e),
-            "dimensions": [],
-            "count": 0
+        raise ResponseProcessingError(str(e)) from e
+
+async def get_ga4_data_batch(inputs: list[GA4QueryInput]) -> list[dict]:
+    """
+    Run several GA4 queries at once, returning results in input order.
+
+    Queries for the same user and property are coalesced into
+    batchRunReports calls of up to five reports each.
+    """
+    return list(await asyncio.gather(*(get_ga4_data(input) for input in inputs)))
+
+def _describe_fields(fields) -> list[dict]:
+    """Project GA4 dimension/metric metadata onto the fields exposed to agents."""
+    return [
+        {
+            "name": f.api_name,
+            "displayName": f.ui_name,
+            "description": f.description
         }
+        for f in fields
+    ]
 
-async def list_ga4_metrics(input: BasicQueryInput) -> dict:
-    """List all available GA4 metrics for the user's property."""
+async def _get_metadata(client: BetaAnalyticsDataClient, property_id: str) -> tuple[list[dict], list[dict]]:
+    """Return a property's dimension and metric descriptions, cached since the GA4 schema rarely changes."""
+    cached = _metadata_cache.get(property_id)
+    if cached is not None:
+        return cached
+    metadata = await _call_ga4(
+        property_id, client.get_metadata, GetMetadataRequest(name=f"properties/{property_id}/metadata")
+    )
+    described = (_describe_fields(metadata.dimensions), _describe_fields(metadata.metrics))
+    _metadata_cache[property_id] = described
+    return described
+
+async def list_ga4_metadata(input: BasicQueryInput) -> dict:
+    """List all available GA4 dimensions and metrics with a single metadata request."""
     try:
-        logger.info(f"Getting metrics for user: {input.user_id}")
-        
-        refresh_token, property_id = get_user_credentials(input.user_id)
-        creds = always_refresh_user_tokens(refresh_token)
-        client = BetaAnalyticsDataClient(credentials=creds)
+        logger.info("Getting metadata for user: %s", input.user_id)
         
-        metadata = client.get_metadata(GetMetadataRequest(name=f"properties/{property_id}/metadata"))
+        client, property_id = await get_authenticated_client(input.user_id)
         
-        metrics = []
-        for m in metadata.metrics:
-            metrics.append({
-                "name": m.api_name,
-                "displayName": m.ui_name,
-                "description": m.description
-            })
+        dimensions, metrics = await _get_metadata(client, property_id)
         
-        logger.info(f"Retrieved {len(metrics)} metrics")
+        logger.info("Retrieved %s dimensions and %s metrics", len(dimensions), len(metrics))
         
         return {
             "success": True,
+            "dimensions": dimensions,
             "metrics": metrics,
-            "count": len(metrics),
+            "dimensionCount": len(dimensions),
+            "metricCount": len(metrics),
             "propertyId": property_id
         }
     except Exception as e:
-        logger.error(f"Error in list_ga4_metrics: {str(e)}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        logger.exception("Error in list_ga4_metadata: %s", e)
         return {
             "success": False,
             "error": str(e),
+            "dimensions": [],
             "metrics": [],
+            "dimensionCount": 0,
+            "metricCount": 0
+        }
+
+async def list_ga4_dimensions(input: BasicQueryInput) -> dict:
+    """List all available GA4 dimensions for the user's property."""
+    result = await list_ga4_metadata(input)
+    if not result["success"]:
+        return {
+            "success": False,
+            "error": result["error"],
+            "dimensions": [],
             "count": 0
-        }
\ No newline at end of file
+        }
+    return {
+        "success": True,
+        "dimensions": result["dimensions"],
+        "count": result["dimensionCount"],
+        "propertyId": result["propertyId"]
+    }
+
+async def list_ga4_metrics(input: BasicQueryInput) -> dict:
+    """List all available GA4 metrics for the user's property."""
+    result = await list_ga4_metadata(input)
+    if not result["success"]:
+        return {
+            "success": False,
+            "error": result["error"],
+            "metrics": [],
+            "count": 0
+        }
+    return {
+        "success": True,
+        "metrics": result["metrics"],
+        "count": result["metricCount"],
+        "propertyId": result["propertyId"]
+    }
@@ -1,18 +1,51 @@
 from fastmcp import FastMCP
-from models import GA4QueryInput, BasicQueryInput
-from ga4_service import get_ga4_data, list_ga4_dimensions, list_ga4_metrics
+from fastmcp.tools import ToolResult
+from mcp.types import TextContent
+from models import GA4QueryInput, GA4QueryBatch, BasicQueryInput
 from utils import get_date_suggestions
+import config  # validates the environment, so a misconfigured server fails at startup
+import argparse
+import functools
+import inspect
 import logging
-import traceback
+import orjson
+import sys
+import threading
+
+__all__ = ["mcp"]
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _lazy_load():
+    """
+    Import ga4_service on first use, so importing this module (or answering
+    get_common_date_ranges) doesn't load the GA4 SDK and Supabase client.
+    The server warms it in a background thread as it starts.
+    """
+    import ga4_service
+    return ga4_service
+
+# Tool results are plain dicts; encode them once with orjson as the tool's
+# text content. Unknown types fall back to str, as in FastMCP's own encoder.
+# The tools declare no output schema, so the payload isn't sent a second
+# time as structured content.
+def encoded_tool_result(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs) -> ToolResult:
+        result = await func(*args, **kwargs)
+        text = orjson.dumps(result, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        return ToolResult(content=[TextContent(type="text", text=text)])
+    wrapper.__annotations__ = {**func.__annotations__, "return": ToolResult}
+    wrapper.__signature__ = inspect.signature(func).replace(return_annotation=ToolResult)
+    return wrapper
+
 # Initialize MCP Server
 mcp = FastMCP("GA4 Analytics MCP Server")
 
 @mcp.tool()
+@encoded_tool_result
 async def query_ga4_data(input: GA4QueryInput) -> dict:
     """
     Query Google Analytics 4 data with specific dimensions and metrics.
@@ -44,21 +77,20 @@ async def query_ga4_data(input: GA4QueryInput) -> dict:
     - For page performance: dimensions=["pagePath"], metrics=["pageviews", "users"]
     """
     try:
-        logger.info(f"Querying GA4 data for user: {input.user_id}")
-        logger.info(f"Dimensions: {input.dimensions}, Metrics: {input.metrics}")
-        logger.info(f"Date range: {input.start_date} to {input.end_date}")
+        logger.info("Querying GA4 data for user: %s", input.user_id)
+        logger.info("Dimensions: %s, Metrics: %s", input.dimensions, input.metrics)
+        logger.info("Date range: %s to %s", input.start_date, input.end_date)
         
-        result = await get_ga4_data(input)
+        result = await _lazy_load().get_ga4_data(input)
         
-        logger.info(f"Query result success: {result.get('success', False)}")
+        logger.info("Query result success: %s", result.get('success', False))
         if not result.get('success', False):
-            logger.error(f"Query failed: {result.get('error', 'Unknown error')}")
+            logger.error("Query failed: %s", result.get('error', 'Unknown error'))
         
         return result
         
     except Exception as e:
-        logger.error(f"Error in query_ga4_data: {str(e)}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        logger.exception("Error in query_ga4_data: %s", e)
         return {
             "success": False,
             "error": f"Tool execution error: {str(e)}",
@@ -67,6 +99,40 @@ async def query_ga4_data(input: GA4QueryInput) -> dict:
         }
 
 @mcp.tool()
+@encoded_tool_result
+async def query_ga4_data_batch(inputs: GA4QueryBatch) -> dict:
+    """
+    Run several GA4 queries in one call.
+    
+    Each entry takes the same parameters as query_ga4_data. Queries against the
+    same property are sent to GA4 together, so prefer this over repeated
+    query_ga4_data calls when you need several reports (e.g. sessions by
+    country and sessions by device) at once.
+    
+    Results are returned in the same order as the inputs. Up to 20 queries
+    can be sent per call.
+    """
+    try:
+        logger.info("Querying %s GA4 reports in batch", len(inputs))
+        results = await _lazy_load().get_ga4_data_batch(inputs)
+        succeeded = sum(1 for result in results if result.get('success', False))
+        logger.info("Batch query finished: %s/%s succeeded", succeeded, len(results))
+        return {
+            "success": succeeded == len(results),
+            "results": results,
+            "count": len(results)
+        }
+    except Exception as e:
+        logger.exception("Error in query_ga4_data_batch: %s", e)
+        return {
+            "success": False,
+            "error": f"Tool execution error: {str(e)}",
+            "results": [],
+            "count": 0
+        }
+
+@mcp.tool()
+@encoded_tool_result
 async def get_available_dimensions(input: BasicQueryInput) -> dict:
     """
     List all available GA4 dimensions for the user's property.
@@ -77,12 +143,12 @@ async def get_available_dimensions(input: BasicQueryInput) -> dict:
     Use this when you need to know what dimensions you can use in your queries.
     """
     try:
-        logger.info(f"Getting available dimensions for user: {input.user_id}")
-        result = await list_ga4_dimensions(input)
-        logger.info(f"Dimensions query success: {result.get('success', False)}")
+        logger.info("Getting available dimensions for user: %s", input.user_id)
+        result = await _lazy_load().list_ga4_dimensions(input)
+        logger.info("Dimensions query success: %s", result.get('success', False))
         return result
     except Exception as e:
-        logger.error(f"Error in get_available_dimensions: {str(e)}")
+        logger.exception("Error in get_available_dimensions: %s", e)
         return {
             "success": False,
             "error": f"Tool execution error: {str(e)}",
@@ -91,6 +157,7 @@ async def get_available_dimensions(input: BasicQueryInput) -> dict:
         }
 
 @mcp.tool()
+@encoded_tool_result
 async def get_available_metrics(input: BasicQueryInput) -> dict:
     """
     List all available GA4 metrics for the user's property.
@@ -101,12 +168,12 @@ async def get_available_metrics(input: BasicQueryInput) -> dict:
     Use this when you need to know what metrics you can use in your queries.
     """
     try:
-        logger.info(f"Getting available metrics for user: {input.user_id}")
-        result = await list_ga4_metrics(input)
-        logger.info(f"Metrics query success: {result.get('success', False)}")
+        logger.info("Getting available metrics for user: %s", input.user_id)
+        result = await _lazy_load().list_ga4_metrics(input)
+        logger.info("Metrics query success: %s", result.get('success', False))
         return result
     except Exception as e:
-        logger.error(f"Error in get_available_metrics: {str(e)}")
+        logger.exception("Error in get_available_metrics: %s", e)
         return {
             "success": False,
             "error": f"Tool execution error: {str(e)}",
@@ -115,6 +182,33 @@ async def get_available_metrics(input: BasicQueryInput) -> dict:
         }
 
 @mcp.tool()
+@encoded_tool_result
+async def get_available_metadata(input: BasicQueryInput) -> dict:
+    """
+    List all available GA4 dimensions and metrics for the user's property.
+    
+    This returns both lists from a single GA4 metadata request, so prefer it
+    over calling get_available_dimensions and get_available_metrics separately
+    when you need both.
+    """
+    try:
+        logger.info("Getting available metadata for user: %s", input.user_id)
+        result = await _lazy_load().list_ga4_metadata(input)
+        logger.info("Metadata query success: %s", result.get('success', False))
+        return result
+    except Exception as e:
+        logger.exception("Error in get_available_metadata: %s", e)
+        return {
+            "success": False,
+            "error": f"Tool execution error: {str(e)}",
+            "dimensions": [],
+            "metrics": [],
+            "dimensionCount": 0,
+            "metricCount": 0
+        }
+
+@mcp.tool()
+@encoded_tool_result
 async def get_common_date_ranges() -> dict:
     """
     Get common date range suggestions for GA4 queries.
@@ -128,7 +222,7 @@ async def get_common_date_ranges() -> dict:
         logger.info("Date ranges retrieved successfully")
         return result
     except Exception as e:
-        logger.error(f"Error in get_common_date_ranges: {str(e)}")
+        logger.exception("Error in get_common_date_ranges: %s", e)
         return {
             "success": False,
             "error": f"Tool execution error: {str(e)}",
@@ -137,13 +231,33 @@ async def get_common_date_ranges() -> dict:
         }
 
 if __name__ == "__main__":
-    print("Starting GA4 MCP Server for N8N AI Agent...")
-    print("Available tools:")
-    print("1. query_ga4_data - Query GA4 data with specific parameters")
-    print("2. get_available_dimensions - List available dimensions")
-    print("3. get_available_metrics - List available metrics")
-    print("4. get_common_date_ranges - Get common date range suggestions")
-    print("Server ready for AI agent integration!")
+    parser = argparse.ArgumentParser(description="GA4 Analytics MCP Server")
+    parser.add_argument(
+        "--transport",
+        choices=["streamable-http", "sse", "stdio"],
+        default="streamable-http",
+        help="MCP transport; use stdio when the agent runs the server as a subprocess"
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    
+    # With stdio, stdout carries the MCP protocol itself
+    out = sys.stderr if args.transport == "stdio" else sys.stdout
+    print("Starting GA4 MCP Server for N8N AI Agent...", file=out)
+    print("Available tools:", file=out)
+    print("1. query_ga4_data - Query GA4 data with specific parameters", file=out)
+    print("2. query_ga4_data_batch - Run several GA4 queries in one call", file=out)
+    print("3. get_available_dimensions - List available dimensions", file=out)
+    print("4. get_available_metrics - List available metrics", file=out)
+    print("5. get_available_metadata - List available dimensions and metrics together", file=out)
+    print("6. get_common_date_ranges - Get common date range suggestions", file=out)
+    # Load the GA4 SDK and Supabase client off the event loop while the server
+    # starts; a GA4 tool call arriving first just waits for the import
+    threading.Thread(target=_lazy_load, name="ga4-warmup", daemon=True).start()
+    print("Server ready for AI agent integration!", file=out)
     
-    # Use SSE transport for MCP server
-    mcp.run(transport="sse", host="0.0.0.0", port=8000)
\ No newline at end of file
+    if args.transport == "stdio":
+        mcp.run(transport="stdio")
+    else:
+        mcp.run(transport=args.transport, host=args.host, port=args.port)
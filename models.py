@@ -1,15 +1,23 @@
-from pydantic import BaseModel, Field, validator
-from typing import Optional, List
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+from typing import Annotated, Literal, Optional, List
 from datetime import datetime
 import re
 
+ResponseFormat = Literal["rows", "compact", "columnar", "proto"]
+
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+# Constraints are declared on the fields where possible so pydantic-core checks
+# them natively; validators are left for what the constraints can't express
 class GA4QueryInput(BaseModel):
-    user_id: str = Field(..., description="User ID to identify whose GA4 tokens to use")
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    user_id: str = Field(..., min_length=1, description="User ID to identify whose GA4 tokens to use")
     dimensions: List[str] = Field(default=[], description="GA4 dimension names (e.g., ['date', 'country', 'pagePath'])")
-    metrics: List[str] = Field(..., description="GA4 metric names (e.g., ['sessions', 'pageviews', 'users'])")
+    metrics: List[str] = Field(..., min_length=1, description="GA4 metric names (e.g., ['sessions', 'pageviews', 'users'])")
     start_date: str = Field(..., description="Start date in YYYY-MM-DD format (e.g., '2025-06-09')")
     end_date: str = Field(..., description="End date in YYYY-MM-DD format (e.g., '2025-07-08')")
-    limit: Optional[int] = Field(default=10000, description="Maximum number of rows to return (default: 100)")
+    limit: Optional[int] = Field(default=10000, ge=1, le=10000, description="Maximum number of rows to return (default: 100)")
     property_id: Optional[str] = Field(default=None, description="Override GA4 property ID if needed")
     
     filters: Optional[dict] = Field(default=None, description="Filter expressions for dimensions and metrics (GA4 API FilterExpression)")
@@ -17,11 +25,14 @@ class GA4QueryInput(BaseModel):
     currency_code: Optional[str] = Field(default=None, description="Currency code for monetary metrics (e.g., 'USD')")
     granularity: Optional[str] = Field(default="daily", description="Granularity for date-based queries (e.g., 'daily', 'weekly', 'monthly')")
     include_empty_rows: Optional[bool] = Field(default=False, description="Whether to include rows with zero values")
+    split_by_date: Optional[bool] = Field(default=False, description="Fetch long reports broken down by date as several concurrent date-range queries; faster for large reports but uses more GA4 quota")
+    response_format: Optional[ResponseFormat] = Field(default="rows", description="Shape of 'data': 'rows' for one object per row, 'compact' for one value list per row in the order of 'columns', 'columnar' for one list per column (smaller for large reports), 'proto' for a base64-encoded GA4 RunReportResponse")
 
-    @validator('start_date', 'end_date')
+    @field_validator('start_date', 'end_date')
+    @classmethod
     def validate_date_format(cls, v):
         """Validate date format is YYYY-MM-DD"""
-        if not re.match(r'^\d{4}-\d{2}-\d{2}$', v):
+        if not DATE_PATTERN.match(v):
             raise ValueError('Date must be in YYYY-MM-DD format')
         
         # Try to parse the date to ensure it's valid
@@ -32,33 +43,18 @@ class GA4QueryInput(BaseModel):
         
         return v
 
-    @validator('metrics')
-    def validate_metrics_not_empty(cls, v):
-        """Ensure at least one metric is provided"""
-        if not v:
-            raise ValueError('At least one metric must be specified')
-        return v
-
-    @validator('limit')
-    def validate_limit(cls, v):
-        """Ensure limit is within reasonable bounds"""
-        if v is not None and (v < 1 or v > 10000):
-            raise ValueError('Limit must be between 1 and 10000')
-        return v
+    @field_validator('response_format')
+    @classmethod
+    def default_response_format(cls, v):
+        """Treat an explicit null response_format as the default layout"""
+        return "rows" if v is None else v
 
-    @validator('user_id')
-    def validate_user_id(cls, v):
-        """Ensure user_id is not empty"""
-        if not v or not v.strip():
-            raise ValueError('User ID cannot be empty')
-        return v.strip()
+# The queries of one query_ga4_data_batch call, capped so a single call can't
+# queue an unbounded number of reports
+MAX_BATCH_QUERIES = 20
+GA4QueryBatch = Annotated[List[GA4QueryInput], Field(min_length=1, max_length=MAX_BATCH_QUERIES)]
 
 class BasicQueryInput(BaseModel):
-    user_id: str = Field(..., description="User ID to identify whose GA4 tokens to use")
-    
-    @validator('user_id')
-    def validate_user_id(cls, v):
-        """Ensure user_id is not empty"""
-        if not v or not v.strip():
-            raise ValueError('User ID cannot be empty')
-        return v.strip()
\ No newline at end of file
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    user_id: str = Field(..., min_length=1, description="User ID to identify whose GA4 tokens to use")
\ No newline at end of file
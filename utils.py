@@ -1,4 +1,7 @@
-from datetime import datetime, timedelta
+from datetime import date, timedelta
+
+# (date the suggestions were computed for, suggestions); they only change at midnight
+_suggestions_cache: tuple[date, dict] | None = None
 
 def get_date_suggestions() -> dict:
     """
@@ -7,7 +10,15 @@ def get_date_suggestions() -> dict:
     This provides pre-calculated date ranges that are commonly used in analytics.
     Use this to help convert relative date expressions into specific dates.
     """
-    today = datetime.now()
+    global _suggestions_cache
+    today = date.today()
+    if _suggestions_cache and _suggestions_cache[0] == today:
+        return _suggestions_cache[1]
+    result = _build_date_suggestions(today)
+    _suggestions_cache = (today, result)
+    return result
+
+def _build_date_suggestions(today: date) -> dict:
     yesterday = today - timedelta(days=1)
     week_ago = today - timedelta(days=7)
     month_ago = today - timedelta(days=30)
@@ -15,37 +26,37 @@ def get_date_suggestions() -> dict:
     
     suggestions = {
         "today": {
-            "start_date": today.strftime("%Y-%m-%d"),
-            "end_date": today.strftime("%Y-%m-%d")
+            "start_date": today.isoformat(),
+            "end_date": today.isoformat()
         },
         "yesterday": {
-            "start_date": yesterday.strftime("%Y-%m-%d"),
-            "end_date": yesterday.strftime("%Y-%m-%d")
+            "start_date": yesterday.isoformat(),
+            "end_date": yesterday.isoformat()
         },
         "last_7_days": {
-            "start_date": week_ago.strftime("%Y-%m-%d"),
-            "end_date": yesterday.strftime("%Y-%m-%d")
+            "start_date": week_ago.isoformat(),
+            "end_date": yesterday.isoformat()
         },
         "last_30_days": {
-            "start_date": month_ago.strftime("%Y-%m-%d"),
-            "end_date": yesterday.strftime("%Y-%m-%d")
+            "start_date": month_ago.isoformat(),
+            "end_date": yesterday.isoformat()
         },
         "last_year": {
-            "start_date": year_ago.strftime("%Y-%m-%d"),
-            "end_date": yesterday.strftime("%Y-%m-%d")
+            "start_date": year_ago.isoformat(),
+            "end_date": yesterday.isoformat()
         },
         "this_month": {
-            "start_date": today.replace(day=1).strftime("%Y-%m-%d"),
-            "end_date": today.strftime("%Y-%m-%d")
+            "start_date": today.replace(day=1).isoformat(),
+            "end_date": today.isoformat()
         },
         "last_month": {
-            "start_date": (today.replace(day=1) - timedelta(days=1)).replace(day=1).strftime("%Y-%m-%d"),
-            "end_date": (today.replace(day=1) - timedelta(days=1)).strftime("%Y-%m-%d")
+            "start_date": (today.replace(day=1) - timedelta(days=1)).replace(day=1).isoformat(),
+            "end_date": (today.replace(day=1) - timedelta(days=1)).isoformat()
         }
     }
     
     return {
         "success": True,
         "dateRanges": suggestions,
-        "currentDate": today.strftime("%Y-%m-%d")
+        "currentDate": today.isoformat()
     }
\ No newline at end of file